@@ -4,6 +4,7 @@ from django.db.models.query import QuerySet
 from django.core.handlers.wsgi import WSGIRequest
 
 import hashlib
+import time
 
 from judge.logging import log_debug
 
@@ -28,7 +29,14 @@ def filter_args(args_list):
 l0_cache = caches["l0"] if "l0" in caches else None
 
 
-def cache_wrapper(prefix, timeout=None, expected_type=None):
+def cache_wrapper(
+    prefix,
+    timeout=None,
+    expected_type=None,
+    single_flight=False,
+    encoder=None,
+    decoder=None,
+):
     def get_key(func, *args, **kwargs):
         args_list = list(args)
         signature_args = list(signature(func).parameters.keys())
@@ -69,22 +77,52 @@ def cache_wrapper(prefix, timeout=None, expected_type=None):
                 return False
             return True
 
-        def wrapper(*args, **kwargs):
-            cache_key = get_key(func, *args, **kwargs)
+        def _get_cached(cache_key):
             result = _get(cache_key)
             if result is not None and _validate_type(cache_key, result):
                 _set_l0(cache_key, result)
                 if type(result) == str and result == NONE_RESULT:
-                    result = None
-                return result
+                    return True, None
+                if decoder is not None:
+                    result = decoder(result)
+                return True, result
+            return False, None
+
+        def _compute_and_set(cache_key, args, kwargs):
             result = func(*args, **kwargs)
             if result is None:
                 cache_result = NONE_RESULT
+            elif encoder is not None:
+                cache_result = encoder(result)
             else:
                 cache_result = result
             _set(cache_key, cache_result, timeout)
             return result
 
+        def wrapper(*args, **kwargs):
+            cache_key = get_key(func, *args, **kwargs)
+            hit, result = _get_cached(cache_key)
+            if hit:
+                return result
+            if single_flight:
+                # Only one worker recomputes an expired entry; the others
+                # briefly poll for its result instead of piling onto the DB.
+                lock_key = cache_key + ":lock"
+                if not cache.add(lock_key, 1, 30):
+                    for _ in range(30):
+                        time.sleep(0.1)
+                        hit, result = _get_cached(cache_key)
+                        if hit:
+                            return result
+                    # Gave up waiting; compute without touching the
+                    # holder's lock.
+                    return _compute_and_set(cache_key, args, kwargs)
+                try:
+                    return _compute_and_set(cache_key, args, kwargs)
+                finally:
+                    cache.delete(lock_key)
+            return _compute_and_set(cache_key, args, kwargs)
+
         def dirty(*args, **kwargs):
             cache_key = get_key(func, *args, **kwargs)
             cache.delete(cache_key)
@@ -1,6 +1,7 @@
 import numpy as np
 import os
 import hashlib
+import threading
 
 from django.core.cache import cache
 from django.conf import settings
@@ -80,3 +81,41 @@ class CollabFilter:
                 res.append((scores[p], p))
         res.sort(reverse=True, key=lambda x: x[0])
         return res[:limit]
+
+    # like problem_neighbors, but scores all measures against one stacked
+    # embedding matrix; returns a list of result lists, one per measure
+    def problem_neighbors_multi(self, problem, problemset, measures, limit=None):
+        pid = problem.id
+        if pid not in self.problem_embeddings:
+            return [[] for measure in measures]
+        u = self.problem_embeddings[pid]
+        ids = list(self.problem_embeddings.keys())
+        V = np.stack(list(self.problem_embeddings.values()))
+        candidates = set(problemset)
+        results = []
+        for measure in measures:
+            if measure == self.COSINE:
+                scores = (u / np.linalg.norm(u)).dot(
+                    (V / np.linalg.norm(V, axis=1, keepdims=True)).T
+                )
+            else:
+                scores = u.dot(V.T)
+            res = [(score, id_) for id_, score in zip(ids, scores) if id_ in candidates]
+            res.sort(reverse=True, key=lambda x: x[0])
+            results.append(res[:limit])
+        return results
+
+
+_model_cache = {}
+_model_cache_lock = threading.Lock()
+
+
+def get_collab_filter(name):
+    """Return a per-process CollabFilter singleton, loading embeddings once."""
+    try:
+        return _model_cache[name]
+    except KeyError:
+        with _model_cache_lock:
+            if name not in _model_cache:
+                _model_cache[name] = CollabFilter(name)
+            return _model_cache[name]
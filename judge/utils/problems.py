@@ -1,19 +1,20 @@
+import math
+from array import array
 from collections import defaultdict
-from math import e
 from datetime import datetime, timedelta
 import random
 from enum import Enum
 
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Case, Count, ExpressionWrapper, F, Max, Q, When
+from django.db.models import Count, ExpressionWrapper, F, Max, Q
 from django.db.models.fields import FloatField
 from django.utils import timezone
 from django.utils.translation import gettext as _, gettext_noop
 from django.http import Http404
 
 from judge.models import Problem, Submission
-from judge.ml.collab_filter import CollabFilter
+from judge.ml.collab_filter import CollabFilter, get_collab_filter
 from judge.caching import cache_wrapper
 
 __all__ = [
@@ -24,8 +25,19 @@ __all__ = [
     "user_tester_ids",
 ]
 
+_E = math.e
 
-@cache_wrapper(prefix="user_tester")
+
+def _pack_ids(ids):
+    # ~4 bytes per id on the wire instead of ~28 for a pickled set of ints.
+    return array("i", sorted(ids)).tobytes()
+
+
+def _unpack_ids(buf):
+    return set(array("i", buf))
+
+
+@cache_wrapper(prefix="user_tester", encoder=_pack_ids, decoder=_unpack_ids)
 def user_tester_ids(profile):
     return set(
         Problem.testers.through.objects.filter(profile=profile)
@@ -34,20 +46,17 @@ def user_tester_ids(profile):
     )
 
 
-@cache_wrapper(prefix="user_editable")
+@cache_wrapper(prefix="user_editable", encoder=_pack_ids, decoder=_unpack_ids)
 def user_editable_ids(profile):
     result = set(
-        (
-            Problem.objects.filter(authors=profile)
-            | Problem.objects.filter(curators=profile)
-        )
+        Problem.objects.filter(Q(authors__id=profile.id) | Q(curators__id=profile.id))
         .values_list("id", flat=True)
         .distinct()
     )
     return result
 
 
-@cache_wrapper(prefix="contest_complete")
+@cache_wrapper(prefix="contest_complete", encoder=_pack_ids, decoder=_unpack_ids)
 def contest_completed_ids(participation):
     result = set(
         participation.submissions.filter(
@@ -55,11 +64,12 @@ def contest_completed_ids(participation):
         )
         .values_list("problem__problem__id", flat=True)
         .distinct()
+        .iterator(chunk_size=2000)
     )
     return result
 
 
-@cache_wrapper(prefix="user_complete")
+@cache_wrapper(prefix="user_complete", encoder=_pack_ids, decoder=_unpack_ids)
 def user_completed_ids(profile):
     result = set(
         Submission.objects.filter(
@@ -67,6 +77,7 @@ def user_completed_ids(profile):
         )
         .values_list("problem_id", flat=True)
         .distinct()
+        .iterator(chunk_size=2000)
     )
     return result
 
@@ -74,11 +85,12 @@ def user_completed_ids(profile):
 @cache_wrapper(prefix="contest_attempted")
 def contest_attempted_ids(participation):
     result = {
-        id: {"achieved_points": points, "max_points": max_points}
-        for id, max_points, points in (
-            participation.submissions.values_list(
-                "problem__problem__id", "problem__points"
-            )
+        row["problem__problem__id"]: {
+            "achieved_points": row["points"],
+            "max_points": row["problem__points"],
+        }
+        for row in (
+            participation.submissions.values("problem__problem__id", "problem__points")
             .annotate(points=Max("points"))
             .filter(points__lt=F("problem__points"))
         )
@@ -89,18 +101,16 @@ def contest_attempted_ids(participation):
 @cache_wrapper(prefix="user_attempted")
 def user_attempted_ids(profile):
     result = {
-        id: {
-            "achieved_points": points,
-            "max_points": max_points,
-            "last_submission": last_submission,
-            "code": problem_code,
-            "name": problem_name,
+        row["problem__id"]: {
+            "achieved_points": row["points"],
+            "max_points": row["problem__points"],
+            "last_submission": row["last_submission"],
+            "code": row["problem__code"],
+            "name": row["problem__name"],
         }
-        for id, max_points, problem_code, problem_name, points, last_submission in (
+        for row in (
             Submission.objects.filter(user=profile)
-            .values_list(
-                "problem__id", "problem__points", "problem__code", "problem__name"
-            )
+            .values("problem__id", "problem__points", "problem__code", "problem__name")
             .annotate(points=Max("points"), last_submission=Max("id"))
             .filter(points__lt=F("problem__points"))
         )
@@ -155,64 +165,61 @@ def get_result_data(*args, **kwargs):
             if kwargs is not None
             else Submission.objects
         )
-    raw = (
-        submissions.values("result")
-        .annotate(count=Count("result"))
-        .values_list("result", "count")
+    raw = submissions.aggregate(
+        **{
+            code: Count("id", filter=Q(result=code))
+            for code, label in Submission.RESULT
+        }
     )
     return _get_result_data(defaultdict(int, raw))
 
 
+def problems_by_ids(ids, only=None):
+    """Fetch problems for a list of ids in one query, preserving input order."""
+    qs = Problem.objects
+    if only:
+        qs = qs.only(*only)
+    problems = qs.in_bulk(ids)
+    return [problems[i] for i in ids if i in problems]
+
+
 def editable_problems(user, profile=None):
     subquery = Problem.objects.all()
     if profile is None:
         profile = user.profile
-    if not user.has_perm("judge.edit_all_problem"):
+    can_edit_all = user.has_perm("judge.edit_all_problem")
+    if not can_edit_all:
+        can_edit_public = user.has_perm("judge.edit_public_problem")
         subfilter = Q(authors__id=profile.id) | Q(curators__id=profile.id)
-        if user.has_perm("judge.edit_public_problem"):
+        if can_edit_public:
             subfilter |= Q(is_public=True)
         subquery = subquery.filter(subfilter)
     return subquery
 
 
-@cache_wrapper(prefix="hp", timeout=14400)
+@cache_wrapper(prefix="hp", timeout=14400, single_flight=True)
 def hot_problems(duration, limit):
-    qs = Problem.get_public_problems().filter(
-        submission__date__gt=timezone.now() - duration
-    )
-    qs0 = (
-        qs.annotate(k=Count("submission__user", distinct=True))
-        .order_by("-k")
-        .values_list("k", flat=True)
-    )
-
-    if not qs0:
+    if limit <= 0:
         return []
-    # make this an aggregate
-    mx = float(qs0[0])
-
+    since = timezone.now() - duration
+    # One index probe on submission.date before committing to the full
+    # GROUP BY aggregation over an idle window.
+    if not Submission.objects.filter(date__gt=since).exists():
+        return []
+    qs = Problem.get_public_problems().filter(submission__date__gt=since)
     qs = qs.annotate(unique_user_count=Count("submission__user", distinct=True))
+    mx = qs.aggregate(mx=Max("unique_user_count"))["mx"]
+    if mx is None:
+        return []
+    mx = float(mx)
+
     # fix braindamage in excluding CE
     qs = qs.annotate(
         submission_volume=Count(
-            Case(
-                When(submission__result="AC", then=1),
-                When(submission__result="WA", then=1),
-                When(submission__result="IR", then=1),
-                When(submission__result="RTE", then=1),
-                When(submission__result="TLE", then=1),
-                When(submission__result="OLE", then=1),
-                output_field=FloatField(),
-            )
-        )
-    )
-    qs = qs.annotate(
-        ac_volume=Count(
-            Case(
-                When(submission__result="AC", then=1),
-                output_field=FloatField(),
-            )
-        )
+            "submission",
+            filter=Q(submission__result__in=["AC", "WA", "IR", "RTE", "TLE", "OLE"]),
+        ),
+        ac_volume=Count("submission", filter=Q(submission__result="AC")),
     )
     qs = qs.filter(unique_user_count__gt=max(mx / 3.0, 1))
 
@@ -222,14 +229,16 @@ def hot_problems(duration, limit):
                 0.02
                 * F("points")
                 * (0.4 * F("ac_volume") / F("submission_volume") + 0.6 * F("ac_rate"))
-                + 100 * e ** (F("unique_user_count") / mx),
+                + 100 * _E ** (F("unique_user_count") / mx),
                 output_field=FloatField(),
             )
         )
         .order_by("-ordering")
         .defer("description")[:limit]
     )
-    return qs
+    # Return the evaluated rows; caching the QuerySet object would drag the
+    # whole query state into the cache entry along with the results.
+    return list(qs)
 
 
 @cache_wrapper(prefix="grp", timeout=14400)
@@ -237,26 +246,37 @@ def get_related_problems(profile, problem, limit=8):
     if not profile or not settings.ML_OUTPUT_PATH:
         return None
     problemset = Problem.get_visible_problems(profile.user).values_list("id", flat=True)
-    problemset = problemset.exclude(id__in=user_completed_ids(profile))
+    # Inline the completed-problem exclusion as a subquery rather than
+    # pulling the cached id set into Python and shipping it back as IN (...).
+    problemset = problemset.exclude(
+        id__in=Submission.objects.filter(
+            user=profile, result="AC", points=F("problem__points")
+        ).values("problem_id")
+    )
     problemset = problemset.exclude(id=problem.id)
-    cf_model = CollabFilter("collab_filter")
-    results = cf_model.problem_neighbors(
-        problem, problemset, CollabFilter.DOT, limit
-    ) + cf_model.problem_neighbors(problem, problemset, CollabFilter.COSINE, limit)
-    results = list(set([i[1] for i in results]))
+    cf_model = get_collab_filter("collab_filter")
+    dot_results, cosine_results = cf_model.problem_neighbors_multi(
+        problem, problemset, [CollabFilter.DOT, CollabFilter.COSINE], limit
+    )
+    results = dot_results + cosine_results
+    # Deduplicate while keeping the best score per problem, so the sample
+    # below still draws from a ranking instead of an arbitrary set order.
+    best = {}
+    for score, pid in results:
+        if pid not in best or score > best[pid]:
+            best[pid] = score
+    results = sorted(best, key=best.get, reverse=True)
     seed = datetime.now().strftime("%d%m%Y")
-    random.shuffle(results)
-    results = results[:limit]
-    results = [Problem.objects.get(id=i) for i in results]
-    return results
+    results = random.Random(seed).sample(results, min(limit, len(results)))
+    return problems_by_ids(results, only=("id", "code", "name", "points"))
 
 
 def finished_submission(sub):
-    keys = ["user_complete:%d" % sub.user_id, "user_attempted:%s" % sub.user_id]
+    keys = [f"user_complete:{sub.user_id}", f"user_attempted:{sub.user_id}"]
     if hasattr(sub, "contest"):
         participation = sub.contest.participation
-        keys += ["contest_complete:%d" % participation.id]
-        keys += ["contest_attempted:%d" % participation.id]
+        keys += [f"contest_complete:{participation.id}"]
+        keys += [f"contest_attempted:{participation.id}"]
     cache.delete_many(keys)
 
 
@@ -276,8 +296,8 @@ def get_user_recommended_problems(
     limits,
     shuffle=False,
 ):
-    cf_model = CollabFilter("collab_filter")
-    cf_time_model = CollabFilter("collab_filter_time")
+    cf_model = get_collab_filter("collab_filter")
+    cf_time_model = get_collab_filter("collab_filter_time")
 
     def get_problem_ids_from_type(rec_type, limit):
         if type(rec_type) == int: